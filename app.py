@@ -1,14 +1,21 @@
 import streamlit as st
+import asyncio
+import base64
+import hashlib
+import io
 import json
 import os
-import base64
 import tempfile
 import time
 import zipfile
 import shutil
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import anthropic
+import orjson
+from tenacity import (retry, retry_if_exception, retry_if_exception_type,
+                      stop_after_attempt, wait_exponential_jitter)
 
 # ===================== 页面配置 =====================
 st.set_page_config(
@@ -67,86 +74,288 @@ FIELD_GROUPS = {
 # 所有字段平铺列表（供提取prompt使用）
 ALL_FIELDS = [f for fields in FIELD_GROUPS.values() for f in fields]
 
+# 模板中的 {{占位符}}，一次扫描完成全部替换
+_PLACEHOLDER_RE = re.compile(r"\{\{([^}]+)\}\}")
+# document.xml 中带 IMAGE_xxx 标识的图片引用，及 rels 中 rId → 媒体文件的映射
+_EMBED_RE = re.compile(r'r:embed="(rId\d+)"[^>]*w:comment="(IMAGE_\w+)"')
+_RELS_RE = re.compile(r'Id="(rId\d+)"[^>]*Target="media/([^"]+)"')
+_MEDIA_TARGET_RE = re.compile(r'Target="media/([^"]+)"')
+
+
+# 付费接口响应缓存（磁盘持久化，跨重跑/重启有效）
+CACHE_DIR = Path(__file__).parent / ".cache"
+CACHE_TTL = 3600
+
 
 # ===================== 工具函数 =====================
 
-def pdf_to_images_base64(pdf_path: str, scale: float = 1.2) -> list:
-    """将PDF各页转换为base64图片，scale控制分辨率（越小越省流量）"""
+@st.cache_resource
+def _response_cache():
+    """按内容哈希缓存 Claude / 高德接口响应，避免相同输入重复计费"""
+    import diskcache
+    return diskcache.Cache(str(CACHE_DIR))
+
+
+def _cache_key(*parts) -> str:
+    """由各输入部分计算 SHA-256 缓存键"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _file_sha256(path: str) -> str:
+    """分块计算文件 SHA-256"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def pdf_to_images_base64(pdf_path: str, scale: float = 1.0, quality: int = 60,
+                         gray: bool = True, pages: list = None) -> list:
+    """将PDF各页转换为base64图片，scale/quality控制分辨率与画质（越小越省流量）
+
+    pages 为页码列表（从0计），默认全部页。扫描件以文字为主，默认灰度、低分辨率即可满足识别
+    """
     import fitz
-    doc = fitz.open(pdf_path)
+    from PIL import Image
     images = []
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale))
-        b64 = base64.standard_b64encode(pix.tobytes("jpeg", jpg_quality=75)).decode("utf-8")
-        images.append({"page": page_num + 1, "base64": b64, "media_type": "image/jpeg"})
-    doc.close()
+    with fitz.open(pdf_path) as doc:
+        colorspace = fitz.csGRAY if gray else fitz.csRGB
+        for page_num in (range(len(doc)) if pages is None else pages):
+            page = doc.load_page(page_num)
+            pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=colorspace)
+            # 直接基于像素缓冲区编码JPEG，不经过中间bytes拷贝
+            mode = "L" if pix.n == 1 else "RGB"
+            img = Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, "raw", mode, pix.stride, 1)
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=quality, optimize=False)
+            del img  # 先释放对 samples_mv 的引用，Pixmap 才能正常回收
+            b64 = base64.standard_b64encode(buf.getbuffer()).decode("utf-8")
+            images.append({"page": page_num + 1, "base64": b64, "media_type": "image/jpeg"})
     return images
 
 
-def extract_info_from_pdf(pdf_path: str, api_key: str) -> dict:
-    """用Claude Vision从扫描PDF中提取结构化房产信息，分批处理避免超时"""
-    client = anthropic.Anthropic(api_key=api_key, base_url="https://api.302.ai")
+def _has_values(batch_result) -> bool:
+    """批次结果中是否至少识别出一个有效字段"""
+    if not isinstance(batch_result, dict) or not batch_result:
+        return False
+    return any(v and v != "未提及" for v in batch_result.values())
 
-    with st.spinner("📄 正在将PDF转换为图片..."):
-        images = pdf_to_images_base64(pdf_path, scale=1.2)
-    st.info(f"共转换 {len(images)} 页，开始AI识别...")
 
+@st.cache_resource(max_entries=4)
+def _client(api_key: str, base_url: str = "https://api.302.ai") -> anthropic.Anthropic:
+    """按 api_key 复用同步客户端（SDK 自带连接池），跨调用、跨重跑保持，省去重复的 TCP/TLS 握手"""
+    return anthropic.Anthropic(api_key=api_key, base_url=base_url, max_retries=2, timeout=60.0)
+
+
+def _is_transient_api_error(e: BaseException) -> bool:
+    """限流、服务端错误、网络超时及返回内容非JSON，均视为可重试的瞬时错误"""
+    if isinstance(e, anthropic.APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, (anthropic.APIConnectionError, json.JSONDecodeError))
+
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential_jitter(max=10),
+       retry=retry_if_exception(_is_transient_api_error), reraise=True)
+async def _call_claude_batch(client, batch: list, prompt: str) -> dict:
+    """识别一批页面图片，返回解析后的JSON字典"""
+    content = []
+    for img in batch:
+        content.append({
+            "type": "image",
+            "source": {"type": "base64", "media_type": img["media_type"], "data": img["base64"]}
+        })
+    content.append({"type": "text", "text": prompt})
+
+    response = await client.messages.create(
+        model="claude-sonnet-4-6",
+        max_tokens=2000,
+        messages=[{"role": "user", "content": content}]
+    )
+    raw = response.content[0].text.strip()
+    if "```json" in raw:
+        raw = raw.split("```json")[1].split("```")[0].strip()
+    elif "```" in raw:
+        raw = raw.split("```")[1].split("```")[0].strip()
+    return orjson.loads(raw)
+
+
+async def _extract_async(client, batches: list, prompt: str, on_done=None) -> list:
+    """并发识别所有批次（最多8个同时在途），按批次顺序返回结果（失败的批次为异常对象）"""
+    semaphore = asyncio.Semaphore(8)
+
+    async def run(batch):
+        try:
+            async with semaphore:
+                return await _call_claude_batch(client, batch, prompt)
+        finally:
+            if on_done:
+                on_done()
+
+    return await asyncio.gather(*(run(batch) for batch in batches), return_exceptions=True)
+
+
+def extract_info_from_pdf(pdf_path: str, api_key: str) -> dict:
+    """用Claude Vision从扫描PDF中提取结构化房产信息，分批处理避免超时"""
     json_template = json.dumps({f: "" for f in ALL_FIELDS}, ensure_ascii=False, indent=2)
     extract_prompt = f"""请仔细识别这份房地产估价PDF文档，以JSON格式返回以下字段（未提及填"未提及"）：
 {json_template}
 只返回JSON，不要任何其他文字。"""
 
-    # 分批处理：每批最多3页，避免单次请求过大超时
+    cache = _response_cache()
+    cache_key = _cache_key("extract", _file_sha256(pdf_path), extract_prompt)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        st.info("已识别过相同PDF，直接使用缓存结果")
+        return cached
+
+    with st.spinner("📄 正在将PDF转换为图片..."):
+        images = pdf_to_images_base64(pdf_path)
+    st.info(f"共转换 {len(images)} 页，开始AI识别...")
+
+    # 分批处理：每批最多3页，避免单次请求过大超时；各批互不依赖，并发请求
     BATCH_SIZE = 3
-    all_results = {}
-
-    for batch_start in range(0, len(images), BATCH_SIZE):
-        batch = images[batch_start: batch_start + BATCH_SIZE]
-        batch_end = batch_start + len(batch)
-        with st.spinner(f"🤖 正在识别第 {batch_start+1}-{batch_end} 页..."):
-            content = []
-            for img in batch:
-                content.append({
-                    "type": "image",
-                    "source": {"type": "base64", "media_type": img["media_type"], "data": img["base64"]}
-                })
-            if batch_start == 0:
-                content.append({"type": "text", "text": extract_prompt})
+    batches = [images[i: i + BATCH_SIZE] for i in range(0, len(images), BATCH_SIZE)]
+
+    # 预置全部字段，合并时只检查仍缺失的字段；先出现的（页序靠前的）有效值优先
+    all_results = {f: "" for f in ALL_FIELDS}
+    missing = set(ALL_FIELDS)
+
+    def merge(batch_result):
+        if not missing or not isinstance(batch_result, dict):
+            return
+        for k, v in batch_result.items():
+            if k in missing and v and v != "未提及":
+                all_results[k] = v
+                missing.discard(k)
+                if not missing:
+                    return
+
+    with st.spinner(f"🤖 正在并发识别 {len(batches)} 批页面..."):
+        progress = st.progress(0.0, text=f"已完成 0/{len(batches)} 批")
+        done = 0
+
+        def on_done():
+            nonlocal done
+            done += 1
+            progress.progress(done / len(batches), text=f"已完成 {done}/{len(batches)} 批")
+
+        async def extract_all():
+            # 重试统一由 _call_claude_batch 上的 tenacity 负责，避免与SDK内置重试叠加
+            async with anthropic.AsyncAnthropic(
+                api_key=api_key, base_url="https://api.302.ai", max_retries=0
+            ) as client:
+                results = await _extract_async(client, batches, extract_prompt, on_done)
+                for r in results:
+                    merge(r)
+                # 低分辨率下正常返回但一个字段都没识别出的批次，改用高分辨率彩色图重试（请求出错的批次不重试）；
+                # 重试只索要仍未提取到的字段，不再附带完整模板
+                retry_idx = [i for i, r in enumerate(results) if isinstance(r, dict) and not _has_values(r)]
+                if retry_idx and missing:
+                    progress.progress(1.0, text=f"{len(retry_idx)} 批未识别出信息，提高分辨率重试...")
+                    pages = [img["page"] - 1 for i in retry_idx for img in batches[i]]
+                    hires = iter(pdf_to_images_base64(pdf_path, scale=1.6, quality=80, gray=False, pages=pages))
+                    retry_batches = [[next(hires) for _ in batches[i]] for i in retry_idx]
+                    missing_fields = [f for f in ALL_FIELDS if f in missing]
+                    retry_prompt = f"""仍需提取字段：{orjson.dumps(missing_fields).decode()}
+请仅对这些字段返回JSON（未提及填"未提及"），只返回JSON，不要任何其他文字。"""
+                    retried = await _extract_async(client, retry_batches, retry_prompt)
+                    for i, r in zip(retry_idx, retried):
+                        merge(r)
+                        results[i] = r
+                return results
+
+        batch_results = asyncio.run(extract_all())
+
+    # 程序异常、或所有批次均失败时直接抛出，由调用方提示"提取失败"；
+    # 仅部分批次的接口错误才降级为警告
+    errors = [r for r in batch_results if isinstance(r, Exception)]
+    for e in errors:
+        if not isinstance(e, (anthropic.APIError, json.JSONDecodeError)):
+            raise e
+    if errors and len(errors) == len(batch_results):
+        raise errors[0]
+
+    for batch, batch_result in zip(batches, batch_results):
+        if isinstance(batch_result, Exception):
+            pages = f"第 {batch[0]['page']}-{batch[-1]['page']} 页"
+            if _is_transient_api_error(batch_result):
+                st.warning(f"⚠️ {pages}重试后仍识别失败（{batch_result}），可能是接口暂时繁忙，可稍后重新提取")
             else:
-                already = json.dumps(all_results, ensure_ascii=False)
-                content.append({"type": "text", "text": f"""这是文档后续页面，请补充提取之前未能获取的字段。
-已提取到的信息：{already}
-请从这些页面中提取仍为空或"未提及"的字段，返回JSON，只包含有新值的字段。"""})
-
-            response = client.messages.create(
-                model="claude-sonnet-4-6",
-                max_tokens=2000,
-                messages=[{"role": "user", "content": content}]
-            )
-            raw = response.content[0].text.strip()
-            if "```json" in raw:
-                raw = raw.split("```json")[1].split("```")[0].strip()
-            elif "```" in raw:
-                raw = raw.split("```")[1].split("```")[0].strip()
-            try:
-                batch_result = json.loads(raw)
-                for k, v in batch_result.items():
-                    if v and v != "未提及" and (k not in all_results or not all_results[k] or all_results[k] == "未提及"):
-                        all_results[k] = v
-            except Exception:
-                pass
-
-    for f in ALL_FIELDS:
-        if f not in all_results:
-            all_results[f] = "未提及"
+                st.warning(f"⚠️ {pages}识别失败（{batch_result}），请检查 API Key 或文件后重新提取")
 
+    for f in missing:
+        all_results[f] = "未提及"
+
+    # 有批次最终失败时结果不完整，不写缓存，以便用户重新提取
+    if len(missing) < len(ALL_FIELDS) and not any(isinstance(r, Exception) for r in batch_results):
+        cache.set(cache_key, all_results, expire=CACHE_TTL)
     return all_results
 
 
+# 周边搜索：交通与商业同为密集类别、半径相同，合并为一次请求并按需翻页；
+# 教育、医疗、公园单独请求，避免被密集类别的近距离结果挤掉
+AROUND_QUERIES = [
+    ("交通设施服务|购物服务|超级市场", 1000, ("交通（地铁/公交）", "商业（商场/超市）")),
+    ("中小学|高等院校|幼儿园",         1000, ("教育（学校/幼儿园）",)),
+    ("综合医院|诊所|药店",             1500, ("医疗（医院/诊所）",)),
+    ("公园广场|风景名胜",              1500, ("公园绿地",)),
+]
+AROUND_PAGE_SIZE = 25
+AROUND_MAX_PAGES = 4
+POI_BUCKETS = {
+    "交通设施服务": "交通（地铁/公交）",
+    "科教文化服务": "教育（学校/幼儿园）",
+    "医疗保健服务": "医疗（医院/诊所）",
+    "购物服务":     "商业（商场/超市）",
+    "风景名胜":     "公园绿地",
+}
+
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential_jitter(max=10),
+       retry=retry_if_exception_type(OSError), reraise=True)
+def _amap_get(session, url: str, params: dict) -> dict:
+    """请求高德接口；网络错误、超时及 5xx 指数退避重试（requests 的异常均继承自 OSError）"""
+    resp = session.get(url, params=params, timeout=10)
+    if resp.status_code >= 500:
+        resp.raise_for_status()
+    return resp.json()
+
+
+def _search_around(session, location: str, amap_key: str, type_str: str,
+                   radius: int, keys: tuple) -> dict:
+    """周边POI搜索（types 可用 | 分隔多个类别），按POI大类分入 keys 各桶，每桶取最近5条
+
+    各桶未凑满时继续翻页，直到结果取尽或达到 AROUND_MAX_PAGES；接口返回错误时抛出异常
+    """
+    buckets = {key: [] for key in keys}
+    for page in range(1, AROUND_MAX_PAGES + 1):
+        resp = _amap_get(
+            session, "https://restapi.amap.com/v3/place/around",
+            {"location": location, "types": type_str, "radius": radius, "key": amap_key,
+             "output": "json", "offset": AROUND_PAGE_SIZE, "page": page}
+        )
+        # 限流、Key无效、配额用尽等错误同样以 HTTP 200 返回，status 为 "0"
+        if resp.get("status") != "1":
+            raise RuntimeError(f"高德周边搜索失败：{resp.get('info', '')}（{resp.get('infocode', '')}）")
+        pois = resp.get("pois") or []
+        for poi in pois:
+            key = POI_BUCKETS.get(poi.get("type", "").split(";")[0])
+            if key in buckets and len(buckets[key]) < 5:
+                buckets[key].append(f"{poi.get('name','')}（约{poi.get('distance','')}米）")
+        if len(pois) < AROUND_PAGE_SIZE or all(len(v) >= 5 for v in buckets.values()):
+            break
+    return buckets
+
+
 def search_surroundings(address: str, amap_key: str) -> dict:
-    """高德地图周边搜索"""
+    """高德地图周边搜索（地理编码后，各组类别并发请求）"""
     import requests
+    from requests.adapters import HTTPAdapter
     result = {
         "坐标": None,
         "交通（地铁/公交）": [],
@@ -156,46 +365,46 @@ def search_surroundings(address: str, amap_key: str) -> dict:
         "公园绿地": [],
         "搜索状态": "成功"
     }
+    cache = _response_cache()
+    cache_key = _cache_key("amap", address, amap_key)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
-        geo = requests.get(
-            "https://restapi.amap.com/v3/geocode/geo",
-            params={"address": address, "key": amap_key, "output": "json"},
-            timeout=10
-        ).json()
-        if geo.get("status") != "1" or not geo.get("geocodes"):
-            result["搜索状态"] = "地址解析失败"
-            return result
-        location = geo["geocodes"][0]["location"]
-        result["坐标"] = location
-
-        for type_str, key, radius in [
-            ("交通设施服务",            "交通（地铁/公交）", 1000),
-            ("中小学;高等院校;幼儿园",  "教育（学校/幼儿园）", 1000),
-            ("综合医院;诊所;药店",      "医疗（医院/诊所）",  1500),
-            ("购物服务;超级市场",       "商业（商场/超市）",  1000),
-            ("公园广场;风景名胜",       "公园绿地",          1500),
-        ]:
-            resp = requests.get(
-                "https://restapi.amap.com/v3/place/around",
-                params={"location": location, "types": type_str, "radius": radius,
-                        "key": amap_key, "output": "json", "offset": 5},
-                timeout=10
-            ).json()
-            if resp.get("status") == "1" and resp.get("pois"):
-                for poi in resp["pois"][:5]:
-                    result[key].append(f"{poi.get('name','')}（约{poi.get('distance','')}米）")
+        with requests.Session() as session:
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=len(AROUND_QUERIES)))
+            geo = _amap_get(
+                session, "https://restapi.amap.com/v3/geocode/geo",
+                {"address": address, "key": amap_key, "output": "json"}
+            )
+            if geo.get("status") != "1" or not geo.get("geocodes"):
+                result["搜索状态"] = "地址解析失败"
+                return result
+            location = geo["geocodes"][0]["location"]
+            result["坐标"] = location
+
+            with ThreadPoolExecutor(max_workers=len(AROUND_QUERIES)) as executor:
+                futures = [
+                    executor.submit(_search_around, session, location, amap_key, type_str, radius, keys)
+                    for type_str, radius, keys in AROUND_QUERIES
+                ]
+                for future in as_completed(futures):
+                    result.update(future.result())
     except Exception as e:
         result["搜索状态"] = f"搜索异常: {e}"
+        return result
+
+    cache.set(cache_key, result, expire=CACHE_TTL)
     return result
 
 
 def generate_surrounding_description(info: dict, surroundings: dict, api_key: str) -> tuple:
     """用Claude生成区位描述两段，返回 (段落1, 段落2)"""
-    client = anthropic.Anthropic(api_key=api_key, base_url="https://api.302.ai")
     prompt = f"""根据以下房产信息和周边配套数据，为房地产估价报告生成"区位状况描述与分析"内容。
 
-房产信息：{json.dumps(info, ensure_ascii=False)}
-周边配套：{json.dumps(surroundings, ensure_ascii=False)}
+房产信息：{orjson.dumps(info).decode()}
+周边配套：{orjson.dumps(surroundings).decode()}
 
 请生成两段内容，用 ---SPLIT--- 分隔：
 第一段（约150字）：描述估价对象的具体区位，包括所处小区四至方位、周边住宅小区、基础设施、公共服务设施、交通、商业配套等。
@@ -203,6 +412,13 @@ def generate_surrounding_description(info: dict, surroundings: dict, api_key: st
 
 直接输出正文，不要标题，两段之间用 ---SPLIT--- 分隔。"""
 
+    cache = _response_cache()
+    cache_key = _cache_key("describe", prompt)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    client = _client(api_key)
     response = client.messages.create(
         model="claude-sonnet-4-6",
         max_tokens=800,
@@ -212,72 +428,72 @@ def generate_surrounding_description(info: dict, surroundings: dict, api_key: st
     parts = text.split("---SPLIT---")
     para1 = parts[0].strip() if parts else text
     para2 = parts[1].strip() if len(parts) > 1 else ""
+    cache.set(cache_key, (para1, para2), expire=CACHE_TTL)
     return para1, para2
 
 
-def fill_template(data: dict, output_path: str):
-    """将数据填入 template_v2.docx 模板，替换所有 {{占位符}}"""
-    if not TEMPLATE_PATH.exists():
+def build_report(template_path, output_path: str, data: dict, images: dict = None):
+    """一次性生成报告：替换所有 {{占位符}} 及 IMAGE_xxx 标识的图片，模板只读写一遍
+
+    images: {IMAGE_xxx: (图片字节或二进制文件对象, 扩展名)}，文件对象按块流式写入
+    """
+    template_path = Path(template_path)
+    if not template_path.exists():
         raise FileNotFoundError(
-            f"模板文件不存在：{TEMPLATE_PATH}\n"
-            "请将 template_v2.docx 放在程序同目录下。"
+            f"模板文件不存在：{template_path}\n"
+            f"请将 {template_path.name} 放在程序同目录下。"
         )
-    shutil.copy(str(TEMPLATE_PATH), output_path)
-
-    with zipfile.ZipFile(output_path, 'r') as z:
-        xml_content = z.read('word/document.xml').decode('utf-8')
+    images = images or {}
+
+    with zipfile.ZipFile(template_path, 'r') as zin:
+        xml_content  = zin.read('word/document.xml').decode('utf-8')
+        rels_content = zin.read('word/_rels/document.xml.rels').decode('utf-8')
+
+        # 含placeholder的blip对应的rId → (placeholder, 新图片, 扩展名)；
+        # 同一标识出现在多处时只替换第一处，保证每张新图片只写入一次
+        rid_images = {}
+        seen = set()
+        for m in _EMBED_RE.finditer(xml_content):
+            if m.group(2) in images and m.group(2) not in seen:
+                seen.add(m.group(2))
+                rid_images[m.group(1)] = (m.group(2), *images[m.group(2)])
+
+        # rels中rId对应的原文件名 → (新文件名, 新图片)
+        media_images = {}
+        for m in _RELS_RE.finditer(rels_content):
+            if m.group(1) in rid_images:
+                placeholder, image, image_ext = rid_images[m.group(1)]
+                media_images[m.group(2)] = (f"replaced_{placeholder.lower()}.{image_ext}", image)
+        if media_images:
+            rels_content = _MEDIA_TARGET_RE.sub(
+                lambda m: f'Target="media/{media_images[m.group(1)][0]}"' if m.group(1) in media_images else m.group(0),
+                rels_content
+            )
 
-    for key, value in data.items():
-        xml_content = xml_content.replace("{{" + key + "}}", str(value) if value else "")
+        str_data = {k: (str(v) if v else "") for k, v in data.items()}
+        xml_content = _PLACEHOLDER_RE.sub(lambda m: str_data.get(m.group(1), m.group(0)), xml_content)
 
-    tmp_path = output_path + ".tmp"
-    with zipfile.ZipFile(output_path, 'r') as zin:
-        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zout:
+        # 重新生成的部件用最快的 deflate 级别：压缩率接近默认级别，耗时约减半
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zout:
             for item in zin.infolist():
+                media_name = item.filename[len('word/media/'):]
                 if item.filename == 'word/document.xml':
-                    zout.writestr(item, xml_content.encode('utf-8'))
-                else:
-                    zout.writestr(item, zin.read(item.filename))
-    os.replace(tmp_path, output_path)
-
-
-def replace_image_in_docx(docx_path: str, image_placeholder: str,
-                           new_image_bytes: bytes, image_ext: str = "jpeg"):
-    """替换模板中指定标识（IMAGE_xxx）的图片"""
-    with zipfile.ZipFile(docx_path, 'r') as z:
-        rels_content = z.read('word/_rels/document.xml.rels').decode('utf-8')
-        doc_content  = z.read('word/document.xml').decode('utf-8')
-
-    # 找到含placeholder的blip对应的rId
-    match = re.search(
-        rf'r:embed="(rId\d+)"[^>]*w:comment="{image_placeholder}"', doc_content
-    )
-    if not match:
-        return
-    rid = match.group(1)
-
-    # 找到rels中对应的文件名
-    rels_match = re.search(rf'Id="{rid}"[^>]*Target="media/([^"]+)"', rels_content)
-    if not rels_match:
-        return
-    old_filename = rels_match.group(1)
-    new_filename = f"replaced_{image_placeholder.lower()}.{image_ext}"
-
-    rels_content = rels_content.replace(
-        f'media/{old_filename}', f'media/{new_filename}'
-    )
-
-    tmp_path = docx_path + ".imgtmp"
-    with zipfile.ZipFile(docx_path, 'r') as zin:
-        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as zout:
-            for item in zin.infolist():
-                if item.filename == 'word/_rels/document.xml.rels':
-                    zout.writestr(item, rels_content.encode('utf-8'))
-                elif item.filename == f'word/media/{old_filename}':
-                    zout.writestr(f'word/media/{new_filename}', new_image_bytes)
+                    zout.writestr(item, xml_content.encode('utf-8'),
+                                  compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+                elif item.filename == 'word/_rels/document.xml.rels':
+                    zout.writestr(item, rels_content.encode('utf-8'),
+                                  compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+                elif item.filename.startswith('word/media/') and media_name in media_images:
+                    new_filename, image = media_images[media_name]
+                    if isinstance(image, bytes):
+                        zout.writestr(f'word/media/{new_filename}', image)
+                    else:
+                        with zout.open(f'word/media/{new_filename}', 'w') as dst:
+                            shutil.copyfileobj(image, dst, 1 << 20)
                 else:
-                    zout.writestr(item, zin.read(item.filename))
-    os.replace(tmp_path, docx_path)
+                    # 未改动的部件逐块复制，不把整个文件读入内存
+                    with zin.open(item) as src, zout.open(item, 'w') as dst:
+                        shutil.copyfileobj(src, dst, 256 * 1024)
 
 
 # ===================== 主界面 =====================
@@ -311,7 +527,7 @@ with col1:
         else:
             if st.button("🚀 开始提取信息", type="primary", use_container_width=True):
                 with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
-                    tmp.write(uploaded_pdf.read())
+                    shutil.copyfileobj(uploaded_pdf, tmp, length=1 << 20)
                     tmp_path = tmp.name
                 try:
                     extracted = extract_info_from_pdf(tmp_path, api_key)
@@ -393,6 +609,8 @@ if st.session_state.get("extraction_done"):
             if fetch_surr and amap_key and address:
                 with st.spinner("🗺️ 正在搜索周边配套..."):
                     surroundings = search_surroundings(address, amap_key)
+                if surroundings["搜索状态"] != "成功":
+                    st.warning(f"⚠️ 周边配套获取失败（{surroundings['搜索状态']}），区位描述将仅依据房产信息生成")
 
             # 生成区位描述
             if api_key and address:
@@ -407,12 +625,11 @@ if st.session_state.get("extraction_done"):
             output_path = os.path.join(tempfile.gettempdir(), f"评估报告_{int(time.time())}.docx")
             with st.spinner("📄 正在填充模板生成报告..."):
                 try:
-                    fill_template(fill_data, output_path)
-
-                    # 替换图片
-                    for img_key, img_file in uploaded_images.items():
-                        ext = img_file.name.rsplit(".", 1)[-1].lower()
-                        replace_image_in_docx(output_path, img_key, img_file.read(), ext)
+                    images = {
+                        img_key: (img_file, img_file.name.rsplit(".", 1)[-1].lower())
+                        for img_key, img_file in uploaded_images.items()
+                    }
+                    build_report(TEMPLATE_PATH, output_path, fill_data, images)
 
                     with open(output_path, "rb") as f:
                         doc_bytes = f.read()